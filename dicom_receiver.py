@@ -3,53 +3,92 @@
 DICOM Receiver (SCP) - Receive DICOM files via DIMSE and save to folder
 """
 
+import functools
+import logging
 import os
+import queue
 import sys
+import threading
 import time
 from datetime import datetime
+from logging.handlers import MemoryHandler
 from pydicom import dcmread
 from pydicom.dataset import Dataset
+from pydicom.filewriter import write_file_meta_info
 from pynetdicom import AE, evt, AllStoragePresentationContexts
 from pynetdicom.sop_class import VerificationSOPClass
 
+# Per-instance messages go through a memory-buffered handler so the
+# receive path is not serialized on stdout; errors flush immediately
+log = logging.getLogger(__name__)
+_log_buffer = MemoryHandler(capacity=512, flushLevel=logging.ERROR,
+                            target=logging.StreamHandler())
+log.addHandler(_log_buffer)
+log.setLevel(logging.INFO)
+
+# Path-unsafe characters replaced in IDs used as folder names
+_PID_TABLE = str.maketrans({'/': '_', '\\': '_'})
+
+@functools.lru_cache(maxsize=4096)
+def _ensure_dir(path):
+    """Create a directory once, skipping the syscalls on repeat instances"""
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Bounded queue decoupling the DIMSE thread from disk I/O - the SCP can
+# accept the next C-STORE while writer threads drain the backlog, and the
+# maxsize provides backpressure if the disk falls behind
+_write_queue = queue.Queue(maxsize=64)
+
+def _writer_loop():
+    """Write queued datasets to disk"""
+    while True:
+        filepath, file_meta, dataset_bytes = _write_queue.get()
+        try:
+            with open(filepath, 'wb', buffering=1 << 20) as f:
+                f.write(b'\x00' * 128)
+                f.write(b'DICM')
+                write_file_meta_info(f, file_meta)
+                f.write(dataset_bytes)
+            log.info("✓ Received and saved: %s", os.path.basename(filepath))
+            log.info("  Location: %s", filepath)
+        except Exception as e:
+            log.error("✗ Error saving file: %s", e)
+        finally:
+            _write_queue.task_done()
+
+def _start_writers(count=2):
+    """Start the background writer threads"""
+    for _ in range(count):
+        threading.Thread(target=_writer_loop, daemon=True).start()
+
 def handle_store(event, output_dir):
     """Handle a C-STORE request event"""
     ds = event.dataset
-    
-    # Add file meta information
-    ds.file_meta = event.file_meta
-    
-    # Create subdirectories based on patient and study
-    patient_id = str(ds.PatientID) if hasattr(ds, 'PatientID') else 'Unknown'
-    study_uid = str(ds.StudyInstanceUID) if hasattr(ds, 'StudyInstanceUID') else 'Unknown'
-    series_uid = str(ds.SeriesInstanceUID) if hasattr(ds, 'SeriesInstanceUID') else 'Unknown'
-    
+
+    # Create subdirectories based on patient and study - ds.get is a
+    # single lookup, where hasattr walks pydicom's __getattr__ machinery
+    patient_id = str(ds.get('PatientID', 'Unknown'))
+    study_uid = str(ds.get('StudyInstanceUID', 'Unknown'))
+    series_uid = str(ds.get('SeriesInstanceUID', 'Unknown'))
+
     # Clean up IDs for use as folder names
-    patient_id = patient_id.replace('/', '_').replace('\\', '_')
-    
-    # Create directory structure
-    study_dir = os.path.join(output_dir, patient_id, study_uid, series_uid)
-    os.makedirs(study_dir, exist_ok=True)
-    
+    patient_id = patient_id.translate(_PID_TABLE)
+
+    # Create directory structure (cached - a series shares one directory)
+    study_dir = _ensure_dir(os.path.join(output_dir, patient_id, study_uid, series_uid))
+
     # Generate filename
-    sop_instance_uid = str(ds.SOPInstanceUID) if hasattr(ds, 'SOPInstanceUID') else f'instance_{int(time.time())}'
+    sop_instance_uid = str(ds.get('SOPInstanceUID') or f'instance_{time.time_ns()}')
     filename = f"{sop_instance_uid}.dcm"
     filepath = os.path.join(study_dir, filename)
     
-    # Save the dataset
-    try:
-        ds.save_as(filepath, write_like_original=False)
-        print(f"✓ Received and saved: {filename}")
-        print(f"  Patient: {patient_id}")
-        print(f"  Study: {study_uid}")
-        print(f"  Location: {filepath}")
-        
-        # Return success status
-        return 0x0000
-    except Exception as e:
-        print(f"✗ Error saving file: {str(e)}")
-        # Return failure status
-        return 0xC000
+    # Queue the dataset for the writer threads - the raw transfer-syntax
+    # encoded bytes are written as received, and the C-STORE response goes
+    # out without waiting for the disk (write failures are reported via
+    # the log rather than the DIMSE status)
+    _write_queue.put((filepath, event.file_meta, event.request.DataSet.getvalue()))
+    return 0x0000
 
 def handle_echo(event):
     """Handle a C-ECHO request event"""
@@ -70,7 +109,15 @@ def start_scp(port=11112, ae_title='PYTHON_SCP', output_dir='./received_dicom'):
     
     # Initialize the Application Entity
     ae = AE(ae_title=ae_title)
-    
+
+    # Unlimited PDU size (capped by what the peer offers) - the default
+    # 16 KB PDUs are the main throughput limiter for large datasets
+    ae.maximum_pdu_size = 0
+    ae.maximum_associations = 10
+    ae.acse_timeout = 60
+    ae.dimse_timeout = 60
+    ae.network_timeout = 60
+
     # Support verification (C-ECHO)
     ae.add_supported_context(VerificationSOPClass)
     
@@ -89,9 +136,15 @@ def start_scp(port=11112, ae_title='PYTHON_SCP', output_dir='./received_dicom'):
     print(f"Output Directory: {os.path.abspath(output_dir)}")
     print(f"Ready to receive DICOM files...")
     print("Press Ctrl+C to stop\n")
-    
-    # Start listening for incoming associations
-    ae.start_server(('', port), evt_handlers=handlers)
+
+    # Start the background writers, then listen for incoming associations
+    _start_writers()
+    try:
+        ae.start_server(('', port), evt_handlers=handlers)
+    finally:
+        # Flush any writes still queued, then the buffered log lines
+        _write_queue.join()
+        _log_buffer.flush()
 
 if __name__ == "__main__":
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 11112
@@ -3,10 +3,15 @@
 DICOM Sender - Send DICOM files from a folder to Orthanc via DIMSE
 """
 
+import logging
+import mmap
 import os
 import sys
+from logging.handlers import MemoryHandler
 from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
 from pynetdicom import AE, debug_logger
+from pynetdicom.pdu_primitives import AsynchronousOperationsWindowNegotiation
 from pynetdicom.sop_class import (
     CTImageStorage,
     MRImageStorage,
@@ -29,6 +34,58 @@ from pynetdicom.sop_class import (
 # Configure logging (optional)
 # debug_logger()
 
+# Per-file messages go through a memory-buffered handler so the send
+# loop is not serialized on stdout; errors flush immediately
+log = logging.getLogger(__name__)
+_log_buffer = MemoryHandler(capacity=512, flushLevel=logging.ERROR,
+                            target=logging.StreamHandler())
+log.addHandler(_log_buffer)
+log.setLevel(logging.INFO)
+
+# Storage SOP Classes requested on every association - built once at
+# import so each send only pays the add_requested_context calls
+_STORAGE_CLASSES = (
+    CTImageStorage,
+    MRImageStorage,
+    EnhancedCTImageStorage,
+    EnhancedMRImageStorage,
+    RTStructureSetStorage,
+    RTDoseStorage,
+    RTPlanStorage,
+    SecondaryCaptureImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalMammographyXRayImageStorageForPresentation,
+    ComputedRadiographyImageStorage,
+    UltrasoundImageStorage,
+    PositronEmissionTomographyImageStorage,
+    NuclearMedicineImageStorage,
+    XRayAngiographicImageStorage,
+    XRayRadiofluoroscopicImageStorage,
+)
+
+def _configure_scu(ae):
+    """Apply the shared SCU presentation contexts and PDU tuning"""
+    for storage_class in _STORAGE_CLASSES:
+        ae.add_requested_context(storage_class)
+    # Unlimited PDU size (capped by what the peer offers)
+    ae.maximum_pdu_size = 0
+
+def _iter_files(folder):
+    """Recursively yield file paths using os.scandir (cheaper than os.walk)"""
+    for entry in os.scandir(folder):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _iter_files(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path
+
+def _is_dicom(filepath):
+    """Check for the 'DICM' marker after the 128-byte preamble"""
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(132)[-4:] == b'DICM'
+    except OSError:
+        return False
+
 def send_dicom_files(source_folder, scp_address='localhost', scp_port=4242, scp_ae_title='ORTHANC'):
     """
     Send all DICOM files from a folder to an SCP via DIMSE C-STORE
@@ -41,83 +98,65 @@ def send_dicom_files(source_folder, scp_address='localhost', scp_port=4242, scp_
     """
     # Initialize the Application Entity
     ae = AE(ae_title='PYTHON_SCU')
-    
-    # Add presentation contexts for common SOP Classes
-    storage_classes = [
-        CTImageStorage,
-        MRImageStorage,
-        EnhancedCTImageStorage,
-        EnhancedMRImageStorage,
-        RTStructureSetStorage,
-        RTDoseStorage,
-        RTPlanStorage,
-        SecondaryCaptureImageStorage,
-        DigitalXRayImageStorageForPresentation,
-        DigitalMammographyXRayImageStorageForPresentation,
-        ComputedRadiographyImageStorage,
-        UltrasoundImageStorage,
-        PositronEmissionTomographyImageStorage,
-        NuclearMedicineImageStorage,
-        XRayAngiographicImageStorage,
-        XRayRadiofluoroscopicImageStorage,
-    ]
-    
-    for storage_class in storage_classes:
-        ae.add_requested_context(storage_class)
-    
-    # Find all DICOM files
-    dicom_files = []
-    for root, dirs, files in os.walk(source_folder):
-        for file in files:
-            filepath = os.path.join(root, file)
-            try:
-                # Try to read as DICOM
-                ds = dcmread(filepath, force=True)
-                dicom_files.append(filepath)
-            except:
-                # Not a DICOM file, skip
-                pass
-    
+    _configure_scu(ae)
+
+    # Find all DICOM files - a 132-byte header probe is enough to filter,
+    # so no file gets fully parsed before the send loop reads it once
+    dicom_files = [f for f in _iter_files(source_folder) if _is_dicom(f)]
+
     if not dicom_files:
         print(f"No DICOM files found in {source_folder}")
         return
     
     print(f"Found {len(dicom_files)} DICOM files to send")
     
+    # Request an asynchronous operations window so a peer that supports
+    # it can keep accepting C-STOREs while processing earlier ones;
+    # peers that do not simply ignore the item
+    async_neg = AsynchronousOperationsWindowNegotiation()
+    async_neg.maximum_number_operations_invoked = 16
+    async_neg.maximum_number_operations_performed = 1
+
     # Associate with the SCP
     print(f"Connecting to {scp_ae_title} at {scp_address}:{scp_port}")
-    assoc = ae.associate(scp_address, scp_port, ae_title=scp_ae_title)
+    assoc = ae.associate(scp_address, scp_port, ae_title=scp_ae_title, ext_neg=[async_neg])
     
     if assoc.is_established:
         print("Association established")
         
         success_count = 0
-        for filepath in dicom_files:
-            try:
-                ds = dcmread(filepath)
-                
-                # Ensure we have the required SOP Class UID
-                if hasattr(ds, 'SOPClassUID'):
-                    # Send the dataset
-                    status = assoc.send_c_store(ds)
-                    
+        try:
+            for filepath in dicom_files:
+                try:
+                    # Memory-map the file so the OS pages data in on demand
+                    # instead of copying the whole file onto the Python heap;
+                    # the map stays alive while pynetdicom streams the send
+                    with open(filepath, 'rb') as f, \
+                            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        ds = dcmread(mm)
+                        status = assoc.send_c_store(ds)
+
                     if status:
                         # Check the status of the storage request
                         if status.Status == 0x0000:
-                            print(f"✓ Successfully sent: {os.path.basename(filepath)}")
+                            log.info("✓ Successfully sent: %s", os.path.basename(filepath))
                             success_count += 1
                         else:
-                            print(f"✗ Failed to send {os.path.basename(filepath)}: Status 0x{status.Status:04x}")
+                            log.warning("✗ Failed to send %s: Status 0x%04x",
+                                        os.path.basename(filepath), status.Status)
                     else:
-                        print(f"✗ Failed to send {os.path.basename(filepath)}: No status returned")
-                else:
-                    print(f"✗ Skipping {os.path.basename(filepath)}: No SOP Class UID")
-                    
-            except Exception as e:
-                print(f"✗ Error sending {os.path.basename(filepath)}: {str(e)}")
-        
-        # Release the association
-        assoc.release()
+                        log.warning("✗ Failed to send %s: No status returned",
+                                    os.path.basename(filepath))
+
+                except InvalidDicomError:
+                    # Not a DICOM file, skip
+                    pass
+                except Exception as e:
+                    log.warning("✗ Error sending %s: %s", os.path.basename(filepath), e)
+        finally:
+            # Release the association, then flush the buffered log lines
+            assoc.release()
+            _log_buffer.flush()
         print(f"\nCompleted: {success_count}/{len(dicom_files)} files sent successfully")
     else:
         print("Failed to establish association")
@@ -3,115 +3,361 @@
 DICOMweb Forwarder - Automatically forward studies from Orthanc1 to Orthanc2 via DICOMweb
 """
 
+import os
+import socket
 import sys
 import time
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class TCPNoDelayAdapter(HTTPAdapter):
+    """HTTPAdapter that disables Nagle's algorithm on pooled sockets"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+# Boundary used when re-wrapping a single instance for STOW-RS
+INSTANCE_BOUNDARY = 'DICOMWEB_FORWARDER_PART'
+
+# StudyInstanceUID tag key in QIDO-RS JSON responses
+STUDY_UID_KEY = '0020000D'
+
+def iter_multipart(stream, boundary, chunk=1 << 20):
+    """Yield DICOM parts from a multipart HTTP stream as they arrive
+
+    Keeps a rolling buffer of at most one part plus one chunk so the
+    full response body is never held in memory.
+    """
+    sep = f'--{boundary}'.encode()
+    buf = bytearray()
+    scan = 0  # Offset before which no boundary can start
+    first = True
+
+    while True:
+        data = stream.read(chunk)
+        if not data:
+            break
+        buf += data
+
+        while True:
+            pos = buf.find(sep, scan)
+            if pos < 0:
+                # Only the buffer tail could hold the start of a boundary
+                scan = max(len(buf) - len(sep) + 1, 0)
+                break
+            if first:
+                # Preamble before the opening boundary carries no part
+                first = False
+            else:
+                # DICOM data runs from the end of the part headers to the
+                # CRLF that belongs to the closing boundary
+                dicom_start = buf.find(b'\r\n\r\n', 0, pos)
+                if dicom_start != -1:
+                    end = pos - 2 if buf[pos - 2:pos] == b'\r\n' else pos
+                    dicom_data = bytes(buf[dicom_start + 4:end])
+                    if dicom_data:
+                        yield dicom_data
+            # Compact the consumed bytes
+            del buf[:pos + len(sep)]
+            scan = 0
 
 class DICOMWebForwarder:
-    def __init__(self, source_url, target_url, poll_interval=5):
+    def __init__(self, source_url, target_url, poll_interval=5, max_workers=4,
+                 state_file='.forwarded_studies.txt'):
         """
         Initialize the forwarder
-        
+
         Args:
             source_url: DICOMweb URL of source Orthanc (e.g., http://localhost:8042/dicom-web)
             target_url: DICOMweb URL of target Orthanc (e.g., http://localhost:8043/dicom-web)
             poll_interval: Seconds between polls (default: 5)
+            max_workers: Number of studies to forward concurrently (default: 4)
+            state_file: File recording forwarded study UIDs so a restart
+                        does not re-forward everything (None to disable)
         """
         self.source_url = source_url.rstrip('/')
         self.target_url = target_url.rstrip('/')
         self.poll_interval = poll_interval
+        self.state_file = state_file
         self.forwarded_studies = set()
-        
+        self.pending_studies = set()
+
+        # Poll-delta tracking: ETag of the last study-list response and
+        # the most recent StudyDate seen, used to skip unchanged polls
+        self._studies_etag = None
+        self._since_study_date = None
+
+        # Cursor into the Orthanc /changes changelog, persisted so a
+        # restart resumes where it left off
+        self._changes_since = 0
+        self._since_file = (state_file + '.since') if state_file else None
+        if self._since_file and os.path.exists(self._since_file):
+            try:
+                with open(self._since_file, 'r') as f:
+                    self._changes_since = int(f.read().strip() or 0)
+            except (OSError, ValueError) as e:
+                print(f"Error loading changes cursor: {e}")
+
+        # Load previously forwarded studies
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file, 'r') as f:
+                    self.forwarded_studies = set(f.read().splitlines())
+                print(f"Loaded {len(self.forwarded_studies)} previously forwarded studies")
+            except OSError as e:
+                print(f"Error loading state file: {e}")
+
+        # One session shared across worker threads so connections are kept
+        # alive and reused instead of paying TCP/TLS setup per request
+        self.session = requests.Session()
+        adapter = TCPNoDelayAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # Separate pool for per-instance uploads so study workers waiting
+        # on their instances cannot deadlock the executor
+        self.stow_pool = ThreadPoolExecutor(max_workers=max_workers)
+
     def get_studies(self, url):
-        """Query all studies from DICOMweb server"""
+        """Query all studies from DICOMweb server via QIDO-RS
+
+        Asks only for StudyInstanceUID and pages through the results, so
+        each poll downloads a few bytes per study instead of the full
+        default attribute set.
+        """
+        studies = []
+        offset = 0
+        limit = 500
+        max_date = self._since_study_date
         try:
-            response = requests.get(f"{url}/studies", headers={'Accept': 'application/dicom+json'})
-            response.raise_for_status()
-            return response.json()
+            while True:
+                params = {'includefield': '0020000D,00080020', 'limit': limit, 'offset': offset}
+                if self._since_study_date:
+                    # Inclusive lower bound, so the newest day is re-listed
+                    # until its studies are all forwarded
+                    params['StudyDate'] = f"{self._since_study_date}-"
+                headers = {'Accept': 'application/dicom+json'}
+                if offset == 0 and self._studies_etag:
+                    headers['If-None-Match'] = self._studies_etag
+
+                response = self.session.get(f"{url}/studies", params=params, headers=headers)
+                if response.status_code == 304:
+                    # Study list unchanged since the last poll
+                    return []
+                response.raise_for_status()
+                if offset == 0:
+                    self._studies_etag = response.headers.get('ETag')
+
+                # QIDO-RS returns 204 with an empty body past the last page
+                page = response.json() if response.content else []
+                studies.extend(page)
+
+                # Track the newest StudyDate to narrow the next poll
+                for study in page:
+                    dates = study.get('00080020', {}).get('Value') or []
+                    if dates and (max_date is None or dates[0] > max_date):
+                        max_date = dates[0]
+
+                if len(page) < limit:
+                    break
+                offset += limit
         except requests.exceptions.RequestException as e:
             print(f"Error querying studies: {e}")
-            return []
-    
-    def get_study_data(self, url, study_uid):
-        """Retrieve complete study data"""
-        try:
-            # Get the study with all its instances
-            response = requests.get(
-                f"{url}/studies/{study_uid}",
-                headers={'Accept': 'multipart/related; type="application/dicom"'}
-            )
-            response.raise_for_status()
-            return response.content, response.headers.get('Content-Type', '')
-        except requests.exceptions.RequestException as e:
-            print(f"Error retrieving study {study_uid}: {e}")
-            return None, None
+            return studies
+        self._since_study_date = max_date
+        return studies
     
     def forward_study(self, study_uid):
         """Forward a single study from source to target"""
         print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Forwarding study {study_uid}...")
-        
-        # Retrieve study from source
-        study_data, content_type = self.get_study_data(self.source_url, study_uid)
-        if not study_data:
-            print(f"  ✗ Failed to retrieve study from source")
-            return False
-        
-        print(f"  ✓ Retrieved study from source ({len(study_data)} bytes)")
-        
-        # Forward to target via STOW-RS
+
+        # Retrieve study from source as a stream so the upload can start
+        # before the download finishes and the study is never fully buffered
         try:
-            headers = {
-                'Content-Type': content_type if content_type else 'multipart/related; type="application/dicom"'
-            }
-            
-            response = requests.post(
-                f"{self.target_url}/studies",
-                data=study_data,
-                headers=headers
+            response = self.session.get(
+                f"{self.source_url}/studies/{study_uid}",
+                headers={'Accept': 'multipart/related; type="application/dicom"'},
+                stream=True
             )
             response.raise_for_status()
-            
-            print(f"  ✓ Successfully forwarded to target")
-            self.forwarded_studies.add(study_uid)
-            return True
-            
         except requests.exceptions.RequestException as e:
-            print(f"  ✗ Failed to forward to target: {e}")
+            print(f"  ✗ Failed to retrieve study from source: {e}")
+            return False
+
+        content_type = response.headers.get('Content-Type', '')
+        if 'boundary=' not in content_type:
+            print(f"  ✗ Unexpected response type from source: {content_type}")
+            response.close()
             return False
+        boundary = content_type.split('boundary=')[-1].strip('"')
+
+        # Forward each instance as its own STOW-RS request so uploads
+        # overlap the download and a failure only re-sends one instance
+        futures = []
+        try:
+            for dicom_data in iter_multipart(response.raw, boundary):
+                futures.append(self.stow_pool.submit(self._stow_instance, dicom_data))
+        finally:
+            response.close()
+
+        failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except requests.exceptions.RequestException:
+                failed += 1
+
+        if failed:
+            print(f"  ✗ Failed to forward {failed}/{len(futures)} instances to target")
+            return False
+
+        print(f"  ✓ Successfully forwarded {len(futures)} instances to target")
+        self.forwarded_studies.add(study_uid)
+        self._record_forwarded(study_uid)
+        return True
+
+    def _stow_instance(self, dicom_data):
+        """POST a single instance wrapped in its own multipart envelope"""
+        body = b''.join((
+            f'--{INSTANCE_BOUNDARY}\r\n'.encode(),
+            b'Content-Type: application/dicom\r\n\r\n',
+            dicom_data,
+            f'\r\n--{INSTANCE_BOUNDARY}--\r\n'.encode(),
+        ))
+        response = self.session.post(
+            f"{self.target_url}/studies",
+            data=body,
+            headers={
+                'Content-Type': f'multipart/related; type="application/dicom"; boundary={INSTANCE_BOUNDARY}'
+            }
+        )
+        response.raise_for_status()
     
+    def _record_forwarded(self, study_uid):
+        """Append a forwarded study UID to the state file"""
+        if not self.state_file:
+            return
+        try:
+            # O_APPEND keeps short writes atomic across worker threads
+            with open(self.state_file, 'a') as f:
+                f.write(study_uid + '\n')
+        except OSError as e:
+            print(f"  ⚠ Error updating state file: {e}")
+
+    def _forward_task(self, study_uid):
+        """Worker wrapper that clears the pending flag when done"""
+        try:
+            self.forward_study(study_uid)
+        finally:
+            self.pending_studies.discard(study_uid)
+
     def check_and_forward_studies(self):
         """Check for new studies and forward them"""
         # Get studies from source
         source_studies = self.get_studies(self.source_url)
-        
+
+        # Hoist the membership tests out of the per-study loop
+        already_forwarded = self.forwarded_studies.__contains__
+        already_pending = self.pending_studies.__contains__
+
         for study in source_studies:
-            # Extract Study Instance UID
-            study_uid = None
-            if isinstance(study, dict):
-                # Try different possible formats
-                if '0020000D' in study and 'Value' in study['0020000D']:
-                    study_uid = study['0020000D']['Value'][0]
-                elif 'StudyInstanceUID' in study:
-                    study_uid = study['StudyInstanceUID']
-            
-            if study_uid and study_uid not in self.forwarded_studies:
-                # New study found, forward it
-                self.forward_study(study_uid)
+            # Extract Study Instance UID (tag-keyed or keyword-keyed JSON)
+            value = study.get(STUDY_UID_KEY)
+            study_uid = value['Value'][0] if value and 'Value' in value else study.get('StudyInstanceUID')
+
+            if not study_uid or already_forwarded(study_uid) or already_pending(study_uid):
+                continue
+
+            # New study found, forward it in the background so the
+            # download of one study overlaps the upload of another
+            self.pending_studies.add(study_uid)
+            self.pool.submit(self._forward_task, study_uid)
     
+    def _save_changes_cursor(self):
+        """Persist the /changes cursor for restart resilience"""
+        if not self._since_file:
+            return
+        try:
+            with open(self._since_file, 'w') as f:
+                f.write(str(self._changes_since))
+        except OSError as e:
+            print(f"  ⚠ Error saving changes cursor: {e}")
+
+    def _resolve_study_uid(self, base_url, orthanc_id):
+        """Map an Orthanc study ID from the changelog to its StudyInstanceUID"""
+        try:
+            response = self.session.get(f"{base_url}/studies/{orthanc_id}", timeout=10)
+            response.raise_for_status()
+            return response.json().get('MainDicomTags', {}).get('StudyInstanceUID')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error resolving study {orthanc_id}: {e}")
+            return None
+
+    def follow_changes(self):
+        """Forward new studies as they appear in the Orthanc changelog
+
+        Reads /changes on the source's REST root instead of re-listing
+        all studies, so idle cycles cost one tiny request and new
+        studies are picked up as soon as they are stored. Returns False
+        if the source does not expose /changes, so the caller can fall
+        back to QIDO-RS polling.
+        """
+        base_url = self.source_url.rsplit('/dicom-web', 1)[0]
+
+        while True:
+            response = self.session.get(
+                f"{base_url}/changes",
+                params={'since': self._changes_since, 'limit': 100},
+                timeout=30
+            )
+            if response.status_code in (400, 404):
+                # Not an Orthanc REST API
+                return False
+            response.raise_for_status()
+            changes = response.json()
+
+            for change in changes.get('Changes', []):
+                if change.get('ChangeType') != 'NewStudy':
+                    continue
+                study_uid = self._resolve_study_uid(base_url, change.get('ID'))
+                if study_uid and study_uid not in self.forwarded_studies \
+                        and study_uid not in self.pending_studies:
+                    self.pending_studies.add(study_uid)
+                    self.pool.submit(self._forward_task, study_uid)
+
+            self._changes_since = changes.get('Last', self._changes_since)
+            self._save_changes_cursor()
+            if changes.get('Done'):
+                # Caught up with the changelog - rest until the next batch
+                time.sleep(self.poll_interval)
+
     def run(self):
-        """Main loop - continuously check and forward studies"""
+        """Main loop - follow the source changelog, or poll if unavailable"""
         print(f"DICOMweb Forwarder Started")
         print(f"Source: {self.source_url}")
         print(f"Target: {self.target_url}")
         print(f"Poll interval: {self.poll_interval} seconds")
         print(f"\nMonitoring for new studies...")
-        
+
+        use_changes = True
         while True:
             try:
-                self.check_and_forward_studies()
-                time.sleep(self.poll_interval)
+                if use_changes:
+                    use_changes = self.follow_changes()
+                    if use_changes is False:
+                        print("Changes API unavailable, falling back to QIDO-RS polling")
+                else:
+                    self.check_and_forward_studies()
+                    time.sleep(self.poll_interval)
             except KeyboardInterrupt:
                 print("\n\nForwarder stopped by user")
                 break
@@ -3,11 +3,16 @@
 DICOMweb to DIMSE Forwarder - Retrieve studies from DICOMweb and forward via DIMSE
 """
 
+import logging
+import socket
 import sys
 import requests
 from io import BytesIO
+from logging.handlers import MemoryHandler
+from requests.adapters import HTTPAdapter
 from pydicom import dcmread
 from pynetdicom import AE
+from pynetdicom.pdu_primitives import AsynchronousOperationsWindowNegotiation
 from pynetdicom.sop_class import (
     CTImageStorage,
     MRImageStorage,
@@ -27,10 +32,57 @@ from pynetdicom.sop_class import (
     XRayRadiofluoroscopicImageStorage,
 )
 
+# Per-instance messages go through a memory-buffered handler so the
+# forward loop is not serialized on stdout; errors flush immediately
+log = logging.getLogger(__name__)
+_log_buffer = MemoryHandler(capacity=512, flushLevel=logging.ERROR,
+                            target=logging.StreamHandler())
+log.addHandler(_log_buffer)
+log.setLevel(logging.INFO)
+
+# Storage SOP Classes requested on every association - built once at
+# import so each forward only pays the add_requested_context calls
+_STORAGE_CLASSES = (
+    CTImageStorage,
+    MRImageStorage,
+    EnhancedCTImageStorage,
+    EnhancedMRImageStorage,
+    RTStructureSetStorage,
+    RTDoseStorage,
+    RTPlanStorage,
+    SecondaryCaptureImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalMammographyXRayImageStorageForPresentation,
+    ComputedRadiographyImageStorage,
+    UltrasoundImageStorage,
+    PositronEmissionTomographyImageStorage,
+    NuclearMedicineImageStorage,
+    XRayAngiographicImageStorage,
+    XRayRadiofluoroscopicImageStorage,
+)
+
+def _configure_scu(ae):
+    """Apply the shared SCU presentation contexts and PDU tuning"""
+    for storage_class in _STORAGE_CLASSES:
+        ae.add_requested_context(storage_class)
+    # Unlimited PDU size (capped by what the peer offers)
+    ae.maximum_pdu_size = 0
+
+class _TCPNoDelayAdapter(HTTPAdapter):
+    """HTTPAdapter that disables Nagle's algorithm on pooled sockets"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+# One keep-alive session for all DICOMweb requests in this process
+SESSION = requests.Session()
+SESSION.mount('http://', _TCPNoDelayAdapter())
+SESSION.mount('https://', _TCPNoDelayAdapter())
+
 def get_all_studies(dicomweb_url):
     """Query all studies from DICOMweb server"""
     try:
-        response = requests.get(f"{dicomweb_url}/studies")
+        response = SESSION.get(f"{dicomweb_url}/studies")
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -38,17 +90,17 @@ def get_all_studies(dicomweb_url):
         return []
 
 def get_study_instances(dicomweb_url, study_uid):
-    """Get all instances for a specific study"""
+    """Get all instances for a specific study, parsed as they arrive"""
     try:
-        response = requests.get(f"{dicomweb_url}/studies/{study_uid}")
+        response = SESSION.get(f"{dicomweb_url}/studies/{study_uid}", stream=True)
         response.raise_for_status()
-        
+
         # Parse multipart DICOM response
         content_type = response.headers.get('Content-Type', '')
         if 'multipart' in content_type:
             # Extract boundary
             boundary = content_type.split('boundary=')[-1].strip('"')
-            return parse_multipart_dicom(response.content, boundary)
+            return iter_multipart(response.raw, boundary)
         else:
             # Single instance
             return [response.content]
@@ -56,77 +108,96 @@ def get_study_instances(dicomweb_url, study_uid):
         print(f"Error retrieving study {study_uid}: {e}")
         return []
 
-def parse_multipart_dicom(data, boundary):
-    """Parse multipart DICOM response"""
-    instances = []
-    parts = data.split(f'--{boundary}'.encode())
-    
-    for part in parts[1:-1]:  # Skip first and last parts
-        # Find the start of DICOM data (after headers)
-        dicom_start = part.find(b'\r\n\r\n')
-        if dicom_start != -1:
-            dicom_data = part[dicom_start + 4:]
-            if dicom_data:
-                instances.append(dicom_data)
-    
-    return instances
+def iter_multipart(stream, boundary, chunk=1 << 20):
+    """Yield DICOM parts from a multipart HTTP stream as they arrive
+
+    Keeps a rolling buffer of at most one part plus one chunk, so the
+    first instance can be forwarded while the rest of the study is still
+    in flight and the full response body is never held in memory.
+    """
+    sep = f'--{boundary}'.encode()
+    buf = bytearray()
+    scan = 0  # Offset before which no boundary can start
+    first = True
+
+    while True:
+        data = stream.read(chunk)
+        if not data:
+            break
+        buf += data
+
+        while True:
+            pos = buf.find(sep, scan)
+            if pos < 0:
+                # No boundary yet - only the buffer tail could hold the
+                # start of one, so resume scanning just before it
+                scan = max(len(buf) - len(sep) + 1, 0)
+                break
+            if first:
+                # Preamble before the opening boundary carries no part
+                first = False
+            else:
+                # Find the start of DICOM data (after the part headers)
+                dicom_start = buf.find(b'\r\n\r\n', 0, pos)
+                if dicom_start != -1:
+                    dicom_data = bytes(buf[dicom_start + 4:pos])
+                    if dicom_data:
+                        yield dicom_data
+            # Compact the consumed bytes
+            del buf[:pos + len(sep)]
+            scan = 0
 
-def forward_to_dimse(dicom_data_list, scp_address, scp_port, scp_ae_title):
-    """Forward DICOM instances to a DIMSE SCP"""
+def forward_to_dimse(dicom_instances, scp_address, scp_port, scp_ae_title):
+    """Forward an iterable of DICOM instances to a DIMSE SCP"""
     # Initialize the Application Entity
     ae = AE(ae_title='DICOMWEB_SCU')
-    
-    # Add presentation contexts
-    storage_classes = [
-        CTImageStorage,
-        MRImageStorage,
-        EnhancedCTImageStorage,
-        EnhancedMRImageStorage,
-        RTStructureSetStorage,
-        RTDoseStorage,
-        RTPlanStorage,
-        SecondaryCaptureImageStorage,
-        DigitalXRayImageStorageForPresentation,
-        DigitalMammographyXRayImageStorageForPresentation,
-        ComputedRadiographyImageStorage,
-        UltrasoundImageStorage,
-        PositronEmissionTomographyImageStorage,
-        NuclearMedicineImageStorage,
-        XRayAngiographicImageStorage,
-        XRayRadiofluoroscopicImageStorage,
-    ]
-    
-    for storage_class in storage_classes:
-        ae.add_requested_context(storage_class)
-    
+    _configure_scu(ae)
+
+    # Request an asynchronous operations window so a peer that supports
+    # it can keep accepting C-STOREs while processing earlier ones;
+    # peers that do not simply ignore the item
+    async_neg = AsynchronousOperationsWindowNegotiation()
+    async_neg.maximum_number_operations_invoked = 16
+    async_neg.maximum_number_operations_performed = 1
+
     # Associate with the SCP
     print(f"Connecting to {scp_ae_title} at {scp_address}:{scp_port}")
-    assoc = ae.associate(scp_address, scp_port, ae_title=scp_ae_title)
+    assoc = ae.associate(scp_address, scp_port, ae_title=scp_ae_title, ext_neg=[async_neg])
     
     if assoc.is_established:
         print("Association established")
         
         success_count = 0
-        for dicom_data in dicom_data_list:
-            try:
-                # Read DICOM from bytes
-                ds = dcmread(BytesIO(dicom_data))
-                
-                # Send the dataset
-                status = assoc.send_c_store(ds)
-                
-                if status and status.Status == 0x0000:
-                    print(f"✓ Successfully forwarded: {ds.SOPInstanceUID}")
-                    success_count += 1
-                else:
-                    print(f"✗ Failed to forward instance")
-                    
-            except Exception as e:
-                print(f"✗ Error forwarding instance: {str(e)}")
-        
-        # Release the association
-        assoc.release()
-        print(f"\nCompleted: {success_count}/{len(dicom_data_list)} instances forwarded")
+        total_count = 0
+        try:
+            for dicom_data in dicom_instances:
+                total_count += 1
+                try:
+                    # Read DICOM from bytes. As long as no element value is
+                    # accessed, pydicom keeps them as raw undecoded bytes and
+                    # pynetdicom's encode is a straight copy of the received
+                    # data rather than a per-element re-serialization
+                    ds = dcmread(BytesIO(dicom_data))
+
+                    # Send the dataset
+                    status = assoc.send_c_store(ds)
+
+                    if status and status.Status == 0x0000:
+                        # Log the UID from the (small, already decoded) file
+                        # meta so the dataset elements stay raw
+                        sop_uid = getattr(ds.file_meta, 'MediaStorageSOPInstanceUID', '<unknown>')
+                        log.info("✓ Successfully forwarded: %s", sop_uid)
+                        success_count += 1
+                    else:
+                        log.warning("✗ Failed to forward instance")
+
+                except Exception as e:
+                    log.warning("✗ Error forwarding instance: %s", e)
+        finally:
+            # Release the association, then flush the buffered log lines
+            assoc.release()
+            _log_buffer.flush()
+        print(f"\nCompleted: {success_count}/{total_count} instances forwarded")
         return success_count
     else:
         print("Failed to establish association")
@@ -152,7 +223,6 @@ def dicomweb_to_dimse_pipeline(dicomweb_url, scp_address, scp_port, scp_ae_title
         print(f"Retrieving study {study_uid}...")
         instances = get_study_instances(dicomweb_url, study_uid)
         if instances:
-            print(f"Retrieved {len(instances)} instances")
             forward_to_dimse(instances, scp_address, scp_port, scp_ae_title)
         else:
             print("No instances found")
@@ -168,7 +238,6 @@ def dicomweb_to_dimse_pipeline(dicomweb_url, scp_address, scp_port, scp_ae_title
                 print(f"\nProcessing study {study_uid}...")
                 instances = get_study_instances(dicomweb_url, study_uid)
                 if instances:
-                    print(f"Retrieved {len(instances)} instances")
                     forwarded = forward_to_dimse(instances, scp_address, scp_port, scp_ae_title)
                     total_forwarded += forwarded
         
@@ -3,24 +3,113 @@
 Orthanc2 Monitor - Continuously monitors Orthanc2 for new studies and pulls them via DIMSE
 """
 
+import logging
+import mmap
 import os
+import queue
 import sys
 import time
 import json
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
+from logging.handlers import MemoryHandler
 import requests
 from pydicom.dataset import Dataset
-from pynetdicom import AE, evt, StoragePresentationContexts, QueryRetrievePresentationContexts
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, evt, StoragePresentationContexts
 from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelMove
 
+# orjson's C parser is several times faster on the multi-megabyte
+# /studies listings; fall back to the stdlib parser when not installed
+try:
+    import orjson
+
+    def _json(response):
+        return orjson.loads(response.content)
+except ImportError:
+    def _json(response):
+        return response.json()
+
+# Optional Bloom filter backend for very large processed-study sets;
+# the exact set remains the default and the only backend when the
+# dependency is not installed
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    ScalableBloomFilter = None
+
+# Per-instance messages go through a memory-buffered handler so the
+# receive path is not serialized on stdout; errors flush immediately
+log = logging.getLogger(__name__)
+_log_buffer = MemoryHandler(capacity=512, flushLevel=logging.ERROR,
+                            target=logging.StreamHandler())
+log.addHandler(_log_buffer)
+log.setLevel(logging.INFO)
+
+def _tag_value(ds, tag, default='Unknown'):
+    """Fetch an element value by integer tag - a direct dict hit, where
+    attribute access pays keyword-to-tag translation on every lookup"""
+    elem = ds.get(tag)
+    return str(elem.value) if elem is not None else default
+
+# Path-unsafe characters replaced in IDs used as folder names - one
+# C-level translate pass instead of chained replace calls
+_PID_TABLE = str.maketrans({c: '_' for c in '/\\:*?"<>|'})
+
+# Alignment required by O_DIRECT for buffer, offset and length
+_DIRECT_ALIGN = 4096
+
+def _direct_write(filepath, data):
+    """Write a file with O_DIRECT, bypassing the kernel page cache
+
+    Received studies are written once and rarely re-read on this host,
+    so pushing hundreds of megabytes per study through the page cache
+    only evicts data that colocated services (Orthanc itself) still
+    need. Raises OSError when the platform or filesystem does not
+    support O_DIRECT; the caller falls back to a buffered write.
+    """
+    if not hasattr(os, 'O_DIRECT'):
+        raise OSError('O_DIRECT not supported on this platform')
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    try:
+        # O_DIRECT needs a page-aligned buffer and length - an anonymous
+        # mmap is page-aligned by construction, padded with zeros
+        size = len(data)
+        aligned = (size + _DIRECT_ALIGN - 1) // _DIRECT_ALIGN * _DIRECT_ALIGN
+        with mmap.mmap(-1, aligned) as buf:
+            buf.write(data)
+            os.write(fd, buf)
+    finally:
+        os.close(fd)
+    # Trim the alignment padding off the tail
+    os.truncate(filepath, size)
+
+def _storage_contexts():
+    """Supported storage contexts, optionally narrowed via env var
+
+    STORAGE_SOP_CLASSES="CT,MR,PT" keeps only the contexts whose SOP
+    class name contains a listed keyword - negotiating a handful of
+    contexts instead of ~130 shrinks every A-ASSOCIATE handshake.
+    """
+    wanted = os.environ.get('STORAGE_SOP_CLASSES', '')
+    keywords = [k.strip().upper() for k in wanted.split(',') if k.strip()]
+    if not keywords:
+        return StoragePresentationContexts
+    contexts = [cx for cx in StoragePresentationContexts
+                if any(k in cx.abstract_syntax.name.upper() for k in keywords)]
+    # An over-narrow filter would reject every C-STORE - fall back to all
+    return contexts or StoragePresentationContexts
+
 class Orthanc2Monitor:
     def __init__(self, orthanc_host='orthanc2', orthanc_http_port=8042, orthanc_dicom_port=4242,
                  orthanc_aet='ORTHANC2', local_aet='PYTHON_SCP', scp_port=11112,
-                 output_dir='/dicom/output', poll_interval=5, reprocess_duplicates=True):
+                 output_dir='/dicom/output', poll_interval=5, reprocess_duplicates=True,
+                 move_workers=4):
         """
         Initialize the Orthanc2 monitoring service
-        
+
         Args:
             orthanc_host: Orthanc hostname
             orthanc_http_port: Orthanc HTTP port
@@ -31,6 +120,7 @@ class Orthanc2Monitor:
             output_dir: Directory to save received files
             poll_interval: Seconds between checks for new studies
             reprocess_duplicates: If True, reprocess ALL studies on every check
+            move_workers: Number of studies to retrieve in parallel
         """
         self.orthanc_host = orthanc_host
         self.orthanc_http_port = orthanc_http_port
@@ -43,8 +133,69 @@ class Orthanc2Monitor:
         self.reprocess_duplicates = reprocess_duplicates
         self.scp_ae = None
         self.received_instances = 0
+
+        # Bounded queue decoupling the DIMSE threads from disk I/O; the
+        # maxsize applies backpressure if the disk falls behind
+        self._write_q = queue.Queue(maxsize=64)
+
+        # Sticky flag - cleared after the first O_DIRECT failure so every
+        # later write goes straight to the buffered path
+        self._use_direct_io = hasattr(os, 'O_DIRECT')
+
+        # Directories already created - a series shares one directory, so
+        # the makedirs syscalls only run once per series
+        self._known_dirs = set()
+        self._dirs_lock = threading.Lock()
         self.processed_studies = set()  # Track which studies we've seen this session
+
+        # Exact backend is split into an immutable snapshot and a small
+        # session delta - the frozenset is sized once at load and never
+        # rehashes as studies are added, only the delta set grows
+        self._processed_base = frozenset()
+        self._processed_new = set()
         self.state_file = os.path.join(output_dir, '.processed_studies.json')
+        self.state_log_file = self.state_file + '.log'
+        self.bloom_file = self.state_file + '.bloom'
+        self._state_log = None
+        self._state_log_count = 0
+        self._state_lock = threading.Lock()
+
+        # Changes-API cursor - where in Orthanc's changelog the monitor
+        # left off, persisted so a restart does not replay old changes
+        self._changes_seq = 0
+        self.changes_seq_file = os.path.join(output_dir, '.changes_seq')
+
+        # Orthanc ID -> StudyInstanceUID cache; Orthanc IDs are content
+        # hashes, so the mapping is stable and repeat detail GETs for
+        # already-seen IDs can be skipped entirely
+        self._study_uid_cache = {}
+        self._uid_cache_dirty = False
+        self.uid_cache_file = os.path.join(output_dir, '.study_uid_cache.json')
+
+        # Pooled keep-alive session for all Orthanc REST calls - reuses
+        # sockets instead of re-handshaking per request, and lets Orthanc
+        # gzip the large listing responses
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2)
+        self.http.mount('http://', adapter)
+        self.http.headers.update({'Accept-Encoding': 'gzip'})
+
+        # Pool for fanning out the per-study detail GETs during a poll
+        self._detail_pool = ThreadPoolExecutor(max_workers=16)
+
+        # Reused C-MOVE SCU - association setup/teardown per study is the
+        # main overhead for bursty retrieves, so keep one alive per worker
+        # thread (a single association cannot run overlapping C-MOVEs)
+        self.move_workers = move_workers
+        self._move_ae = None
+        self._move_ae_lock = threading.Lock()
+        self._move_local = threading.local()
+        self._move_assocs = []
+        self._move_pool = ThreadPoolExecutor(max_workers=move_workers)
+
+        # Delay applied only after a failed retrieve, doubling up to 30s;
+        # successful transfers run back to back with no pacing
+        self._fail_backoff = 0.1
         
         # Create output directory
         os.makedirs(output_dir, exist_ok=True)
@@ -54,97 +205,276 @@ class Orthanc2Monitor:
     
     def load_processed_studies(self):
         """Load the list of previously processed studies"""
+        # The UID cache is valid regardless of the duplicate policy
+        if os.path.exists(self.uid_cache_file):
+            try:
+                with open(self.uid_cache_file, 'r') as f:
+                    self._study_uid_cache = json.load(f)
+            except Exception as e:
+                print(f"Error loading UID cache: {e}")
+                self._study_uid_cache = {}
+
+        if os.path.exists(self.changes_seq_file):
+            try:
+                with open(self.changes_seq_file, 'r') as f:
+                    self._changes_seq = int(f.read().strip() or 0)
+            except Exception as e:
+                print(f"Error loading changes cursor: {e}")
+                self._changes_seq = 0
+
         # When reprocess_duplicates is True, we don't load previous state
-        if not self.reprocess_duplicates and os.path.exists(self.state_file):
+        if self.reprocess_duplicates:
+            return
+
+        if ScalableBloomFilter is not None and os.path.exists(self.bloom_file):
+            # A previous run already migrated to the Bloom filter backend
+            try:
+                with open(self.bloom_file, 'rb') as f:
+                    self.processed_studies = ScalableBloomFilter.fromfile(f)
+            except Exception as e:
+                print(f"Error loading Bloom filter: {e}")
+        elif os.path.exists(self.state_file):
             try:
                 with open(self.state_file, 'r') as f:
                     self.processed_studies = set(json.load(f))
-                print(f"Loaded {len(self.processed_studies)} previously processed studies")
             except Exception as e:
                 print(f"Error loading state file: {e}")
                 self.processed_studies = set()
-    
-    def save_processed_studies(self):
-        """Save the list of processed studies"""
-        if not self.reprocess_duplicates:
+
+        # Replay entries appended since the last compaction
+        if os.path.exists(self.state_log_file):
             try:
-                with open(self.state_file, 'w') as f:
-                    json.dump(list(self.processed_studies), f)
+                with open(self.state_log_file, 'r') as f:
+                    entries = [line.strip() for line in f if line.strip()]
+                for entry in entries:
+                    self.processed_studies.add(entry)
+                self._state_log_count = len(entries)
             except Exception as e:
-                print(f"Error saving state file: {e}")
+                print(f"Error loading state log: {e}")
+
+        # Migrate very large exact sets to a Bloom filter - roughly ten
+        # bits per entry instead of a full Python string plus hash-table
+        # slot; a rare false positive only means one already-stored study
+        # is not re-pulled
+        if (ScalableBloomFilter is not None
+                and isinstance(self.processed_studies, set)
+                and len(self.processed_studies) > 50_000):
+            bloom = ScalableBloomFilter(initial_capacity=100_000, error_rate=0.001)
+            for study_id in self.processed_studies:
+                bloom.add(study_id)
+            self.processed_studies = bloom
+
+        if isinstance(self.processed_studies, set) and self.processed_studies:
+            print(f"Loaded {len(self.processed_studies)} previously processed studies")
+
+        # Freeze the loaded snapshot; new studies land in the delta set
+        if isinstance(self.processed_studies, set):
+            self._processed_base = frozenset(self.processed_studies)
+            self.processed_studies = set()
+
+        # Line-buffered append log - O(1) bytes written per study instead
+        # of rewriting the whole JSON list every time
+        try:
+            self._state_log = open(self.state_log_file, 'a', buffering=1)
+        except Exception as e:
+            print(f"Error opening state log: {e}")
+
+    def save_processed_studies(self, study_id):
+        """Record a processed study by appending one line to the state log"""
+        if self.reprocess_duplicates or self._state_log is None:
+            return
+        with self._state_lock:
+            try:
+                self._state_log.write(study_id + '\n')
+                self._state_log_count += 1
+            except Exception as e:
+                print(f"Error writing state log: {e}")
+                return
+            if self._state_log_count > 10000:
+                self.compact_state()
+
+    def compact_state(self):
+        """Rewrite the JSON snapshot and truncate the append log
+
+        Caller must hold _state_lock.
+        """
+        try:
+            if isinstance(self.processed_studies, set):
+                # Merge the session delta back into the frozen snapshot
+                merged = self._processed_base | self._processed_new
+                with open(self.state_file, 'w') as f:
+                    json.dump(list(merged), f)
+                self._processed_base = frozenset(merged)
+                self._processed_new = set()
+            else:
+                with open(self.bloom_file, 'wb') as f:
+                    self.processed_studies.tofile(f)
+            self._state_log.close()
+            self._state_log = open(self.state_log_file, 'w', buffering=1)
+            self._state_log_count = 0
+        except Exception as e:
+            print(f"Error compacting state: {e}")
+
+    def _is_processed(self, study_id):
+        """Membership across the frozen snapshot and the session delta"""
+        if not isinstance(self.processed_studies, set):
+            return study_id in self.processed_studies  # Bloom filter
+        return study_id in self._processed_base or study_id in self._processed_new
+
+    def _mark_processed(self, study_id):
+        """Record a processed study in memory and append it to the log"""
+        if not isinstance(self.processed_studies, set):
+            self.processed_studies.add(study_id)  # Bloom filter
+        else:
+            self._processed_new.add(study_id)
+        self.save_processed_studies(study_id)
     
     def handle_store(self, event):
         """Handle incoming C-STORE requests"""
         ds = event.dataset
-        ds.file_meta = event.file_meta
-        
+
         # Create subdirectories based on patient and study
-        patient_id = str(ds.PatientID) if hasattr(ds, 'PatientID') else 'Unknown'
-        study_uid = str(ds.StudyInstanceUID) if hasattr(ds, 'StudyInstanceUID') else 'Unknown'
-        series_uid = str(ds.SeriesInstanceUID) if hasattr(ds, 'SeriesInstanceUID') else 'Unknown'
-        
+        patient_id = _tag_value(ds, 0x00100020)
+        study_uid = _tag_value(ds, 0x0020000D)
+        series_uid = _tag_value(ds, 0x0020000E)
+
         # Clean up IDs for folder names
-        patient_id = patient_id.replace('/', '_').replace('\\', '_')
-        
-        # Create directory structure
-        study_dir = os.path.join(self.output_dir, patient_id, study_uid, series_uid)
-        os.makedirs(study_dir, exist_ok=True)
-        
+        patient_id = patient_id.translate(_PID_TABLE)
+
+        # Create directory structure (cached - see _ensure_dir)
+        study_dir = self._ensure_dir(os.path.join(self.output_dir, patient_id, study_uid, series_uid))
+
         # Generate filename
-        sop_instance_uid = str(ds.SOPInstanceUID) if hasattr(ds, 'SOPInstanceUID') else f'instance_{int(time.time())}'
+        sop_instance_uid = _tag_value(ds, 0x00080018, '') or f'instance_{time.time_ns()}'
         filename = f"{sop_instance_uid}.dcm"
         filepath = os.path.join(study_dir, filename)
         
-        # Save the dataset
-        try:
-            ds.save_as(filepath, write_like_original=False)
-            self.received_instances += 1
-            print(f"  ✓ Received instance {self.received_instances}: {filename}")
-            return 0x0000  # Success
-        except Exception as e:
-            print(f"  ✗ Error saving file: {str(e)}")
-            return 0xC000  # Failure
-    
+        # Queue the raw transfer-syntax encoded bytes as received - no
+        # pydicom re-encode - and acknowledge immediately; the association
+        # keeps draining C-STOREs while the writers catch up (failures are
+        # reported in the log rather than the DIMSE status)
+        self._write_q.put((filepath, event.file_meta, event.request.DataSet.getvalue()))
+        return 0x0000  # Success
+
+    def _ensure_dir(self, path):
+        """Create a directory once, skipping the syscalls on repeat instances"""
+        if path not in self._known_dirs:
+            os.makedirs(path, exist_ok=True)
+            with self._dirs_lock:
+                self._known_dirs.add(path)
+        return path
+
+    def _writer_loop(self):
+        """Write queued datasets to disk"""
+        while True:
+            filepath, file_meta, dataset_bytes = self._write_q.get()
+            try:
+                # Assemble the full file image once so it can go out in a
+                # single write on either I/O path
+                buf = BytesIO()
+                buf.write(b'\x00' * 128)
+                buf.write(b'DICM')
+                write_file_meta_info(buf, file_meta)
+                buf.write(dataset_bytes)
+                data = buf.getvalue()
+
+                if self._use_direct_io:
+                    try:
+                        _direct_write(filepath, data)
+                    except OSError:
+                        # Filesystem rejected O_DIRECT (e.g. tmpfs/EINVAL)
+                        self._use_direct_io = False
+                        with open(filepath, 'wb', buffering=1 << 20) as f:
+                            f.write(data)
+                else:
+                    with open(filepath, 'wb', buffering=1 << 20) as f:
+                        f.write(data)
+                self.received_instances += 1
+                log.info("  ✓ Received instance %d: %s",
+                         self.received_instances, os.path.basename(filepath))
+            except Exception as e:
+                log.error("  ✗ Error saving file: %s", e)
+            finally:
+                self._write_q.task_done()
+
     def start_scp(self):
         """Start the Storage SCP"""
         self.scp_ae = AE(ae_title=self.local_aet)
         
-        # Support all storage contexts
-        self.scp_ae.supported_contexts = StoragePresentationContexts
-        
+        # Support the configured storage contexts (all by default)
+        self.scp_ae.supported_contexts = _storage_contexts()
+
+        # One incoming store association per retrieve worker, and
+        # timeouts so a stalled peer cannot pin a server thread forever
+        self.scp_ae.maximum_associations = self.move_workers
+        self.scp_ae.acse_timeout = 30
+        self.scp_ae.dimse_timeout = 60
+        self.scp_ae.network_timeout = 60
+
         # Set handler
         handlers = [(evt.EVT_C_STORE, self.handle_store)]
-        
+
         print(f"Starting Storage SCP on port {self.scp_port}...")
-        
-        # Start server in non-blocking mode
-        self.scp_ae.start_server(
-            ('0.0.0.0', self.scp_port), 
-            evt_handlers=handlers,
-            block=False
-        )
+
+        # Background writers so handle_store never blocks on the disk
+        for _ in range(2):
+            threading.Thread(target=self._writer_loop, daemon=True).start()
+
+        # Run the blocking reactor in a dedicated daemon thread - one
+        # long-lived server thread instead of the non-blocking mode's
+        # extra supervisor thread
+        self._scp_thread = threading.Thread(
+            target=self.scp_ae.start_server,
+            args=(('0.0.0.0', self.scp_port),),
+            kwargs={'evt_handlers': handlers, 'block': True},
+            daemon=True)
+        self._scp_thread.start()
         print(f"✓ Storage SCP started (AE Title: {self.local_aet})")
     
     def stop_scp(self):
-        """Stop the Storage SCP"""
+        """Stop the Storage SCP and release the C-MOVE associations"""
+        # Flush any writes still queued, then the buffered log lines
+        self._write_q.join()
+        _log_buffer.flush()
+
+        # Fold the session delta into the snapshot so the next start
+        # loads one file instead of replaying the whole append log
+        if self._state_log is not None:
+            with self._state_lock:
+                self.compact_state()
+        for assoc in self._move_assocs:
+            if assoc.is_established:
+                assoc.release()
+        self._move_assocs = []
         if self.scp_ae:
             self.scp_ae.shutdown()
             print("Storage SCP stopped")
-    
+
+    def _get_move_assoc(self):
+        """Return this thread's live C-MOVE association, creating it on demand"""
+        assoc = getattr(self._move_local, 'assoc', None)
+        if assoc is None or not assoc.is_established:
+            with self._move_ae_lock:
+                if self._move_ae is None:
+                    # Create SCU for C-MOVE - only the one Q/R context
+                    # actually used gets negotiated
+                    self._move_ae = AE(ae_title=self.local_aet)
+                    self._move_ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
+            # Associate with Orthanc
+            assoc = self._move_ae.associate(
+                self.orthanc_host, self.orthanc_dicom_port, ae_title=self.orthanc_aet)
+            self._move_local.assoc = assoc
+            self._move_assocs.append(assoc)
+        return assoc
+
     def move_study(self, study_uid):
         """Request a study via C-MOVE"""
         print(f"\n  → Requesting study {study_uid} via C-MOVE...")
-        self.received_instances = 0
-        
-        # Create SCU for C-MOVE
-        ae = AE(ae_title=self.local_aet)
-        
-        # Add query/retrieve contexts
-        ae.requested_contexts = QueryRetrievePresentationContexts
-        
-        # Associate with Orthanc
-        assoc = ae.associate(self.orthanc_host, self.orthanc_dicom_port, ae_title=self.orthanc_aet)
-        
+
+        # Reuse the existing association - re-associating per study costs
+        # several round trips of handshake and context negotiation
+        assoc = self._get_move_assoc()
+
         if assoc.is_established:
             # Create identifier dataset
             ds = Dataset()
@@ -155,20 +485,26 @@ class Orthanc2Monitor:
             responses = assoc.send_c_move(ds, self.local_aet, PatientRootQueryRetrieveInformationModelMove)
             
             success = False
+            completed = None
             for (status, identifier) in responses:
                 if status:
-                    # Check if C-MOVE completed successfully
+                    # Check if C-MOVE completed successfully - judge by the
+                    # final status sub-operation counts, since the shared
+                    # instance counter cannot be attributed to one study
+                    # while several moves run in parallel
                     if status.Status == 0x0000:  # Success
                         success = True
+                        completed = getattr(status, 'NumberOfCompletedSuboperations', None)
                     elif status.Status == 0xFF00:  # Pending
                         pass
                     else:
                         print(f"    C-MOVE status: 0x{status.Status:04x}")
-            
-            assoc.release()
-            
-            if success and self.received_instances > 0:
-                print(f"  ✓ Study transfer completed. Received {self.received_instances} instances.")
+
+            if success and completed != 0:
+                if completed:
+                    print(f"  ✓ Study transfer completed. Received {completed} instances.")
+                else:
+                    print(f"  ✓ Study transfer completed.")
                 return True
             else:
                 print(f"  ✗ Study transfer failed or no instances received.")
@@ -180,7 +516,9 @@ class Orthanc2Monitor:
     def delete_study_from_orthanc(self, study_id):
         """Delete a study from Orthanc after successful transfer"""
         try:
-            response = requests.delete(f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies/{study_id}")
+            response = self.http.delete(
+                f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies/{study_id}",
+                timeout=10)
             if response.status_code == 200:
                 print(f"  ✓ Study deleted from Orthanc2")
                 return True
@@ -191,19 +529,141 @@ class Orthanc2Monitor:
             print(f"  ⚠ Error deleting study: {e}")
             return False
     
+    def _save_changes_seq(self):
+        """Persist the changes-API cursor"""
+        try:
+            with open(self.changes_seq_file, 'w') as f:
+                f.write(str(self._changes_seq))
+        except Exception as e:
+            print(f"Error saving changes cursor: {e}")
+
+    def _save_uid_cache(self):
+        """Persist the Orthanc ID -> StudyInstanceUID cache"""
+        try:
+            with open(self.uid_cache_file, 'w') as f:
+                json.dump(self._study_uid_cache, f)
+            self._uid_cache_dirty = False
+        except Exception as e:
+            print(f"Error saving UID cache: {e}")
+
+    def _move_one(self, study):
+        """Retrieve one study and clean up after a successful transfer"""
+        study_id, study_uid = study
+        print(f"\nProcessing study: {study_uid}")
+
+        # Pull the study via C-MOVE
+        if self.move_study(study_uid):
+            # Delete the study from Orthanc2 after successful transfer
+            self.delete_study_from_orthanc(study_id)
+
+            # Mark as processed (only matters when reprocess_duplicates is False)
+            self._mark_processed(study_id)
+            self._fail_backoff = 0.1
+        else:
+            print(f"  ⚠ Failed to retrieve study {study_uid}, will retry later")
+            # Back off so a struggling peer is not hammered with retries
+            self._fail_backoff = min(self._fail_backoff * 2, 30)
+            time.sleep(self._fail_backoff)
+
+    def check_changes(self):
+        """Long-poll the Orthanc changes API for newly stored studies
+
+        `/changes?since=N&wait=30` blocks on the server until something
+        changes, so the monitor wakes exactly when there is work instead
+        of burning a round trip every poll_interval. Returns False when
+        the server does not support the endpoint so monitor() can fall
+        back to polling the study listing.
+        """
+        try:
+            response = self.http.get(
+                f"http://{self.orthanc_host}:{self.orthanc_http_port}/changes",
+                params={'since': self._changes_seq, 'wait': 30},
+                timeout=60)
+            if response.status_code in (400, 404):
+                return False
+            data = _json(response)
+        except Exception as e:
+            print(f"\n✗ Error polling changes: {e}")
+            time.sleep(self.poll_interval)
+            return True
+
+        new_studies = []
+        for change in data.get('Changes', []):
+            if change.get('ChangeType') != 'NewStudy':
+                continue
+            study_id = change.get('ID')
+            if not study_id:
+                continue
+            if not self.reprocess_duplicates and self._is_processed(study_id):
+                continue
+
+            # Resolve the Orthanc ID to a StudyInstanceUID (cached)
+            study_uid = self._study_uid_cache.get(study_id)
+            if not study_uid:
+                try:
+                    details = _json(self.http.get(
+                        f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies/{study_id}",
+                        timeout=10))
+                    study_uid = details.get('MainDicomTags', {}).get('StudyInstanceUID', '')
+                except Exception as e:
+                    print(f"  ⚠ Error resolving study {study_id}: {e}")
+                    continue
+                if study_uid:
+                    self._study_uid_cache[study_id] = study_uid
+                    self._uid_cache_dirty = True
+            if study_uid:
+                new_studies.append((study_id, study_uid))
+
+        self._changes_seq = data.get('Last', self._changes_seq)
+        self._save_changes_seq()
+        if self._uid_cache_dirty:
+            self._save_uid_cache()
+
+        if new_studies:
+            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Found {len(new_studies)} studies to process")
+            list(self._move_pool.map(self._move_one, new_studies))
+        return True
+
     def check_for_new_studies(self):
         """Check Orthanc2 for new studies"""
         try:
-            # Get all studies from Orthanc2
-            response = requests.get(f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies")
-            study_ids = response.json()
-            
-            new_studies = []
-            for study_id in study_ids:
+            # Get all studies from Orthanc2 - ?expand returns every study
+            # with its MainDicomTags in one round trip, replacing the
+            # listing plus one detail GET per study
+            response = self.http.get(
+                f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies?expand",
+                timeout=30)
+            entries = _json(response)
+
+            def fetch_uid(study_id):
+                # Serve repeat lookups from the cache
+                study_uid = self._study_uid_cache.get(study_id)
+                if study_uid:
+                    return study_id, study_uid
+
                 # Get study details
-                study_details = requests.get(f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies/{study_id}").json()
+                study_details = _json(self.http.get(
+                    f"http://{self.orthanc_host}:{self.orthanc_http_port}/studies/{study_id}",
+                    timeout=10))
                 study_uid = study_details.get('MainDicomTags', {}).get('StudyInstanceUID', '')
-                
+                if study_uid:
+                    self._study_uid_cache[study_id] = study_uid
+                    self._uid_cache_dirty = True
+                return study_id, study_uid
+
+            if entries and isinstance(entries[0], str):
+                # Older Orthanc without ?expand support returns bare IDs -
+                # fall back to fanning the detail lookups out over the pool
+                uid_pairs = list(self._detail_pool.map(fetch_uid, entries))
+                if self._uid_cache_dirty:
+                    self._save_uid_cache()
+            else:
+                uid_pairs = [(entry.get('ID'),
+                              entry.get('MainDicomTags', {}).get('StudyInstanceUID', ''))
+                             for entry in entries]
+
+            new_studies = []
+            for study_id, study_uid in uid_pairs:
                 # Check if we should process this study
                 should_process = False
                 
@@ -212,7 +672,7 @@ class Orthanc2Monitor:
                     should_process = True
                 else:
                     # Only process if never seen before
-                    if study_id not in self.processed_studies:
+                    if not self._is_processed(study_id):
                         should_process = True
                 
                 if should_process and study_uid:
@@ -220,38 +680,34 @@ class Orthanc2Monitor:
             
             if new_studies:
                 print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Found {len(new_studies)} studies to process")
-                
-                for study_id, study_uid in new_studies:
-                    print(f"\nProcessing study: {study_uid}")
-                    
-                    # Pull the study via C-MOVE
-                    if self.move_study(study_uid):
-                        # Delete the study from Orthanc2 after successful transfer
-                        self.delete_study_from_orthanc(study_id)
-                        
-                        # Mark as processed (only matters when reprocess_duplicates is False)
-                        self.processed_studies.add(study_id)
-                        self.save_processed_studies()
-                        
-                        # Brief pause between studies
-                        time.sleep(1)
-                    else:
-                        print(f"  ⚠ Failed to retrieve study {study_uid}, will retry later")
-            
+
+                # Retrieve studies in parallel - each worker keeps its own
+                # association, so transfers overlap instead of serializing
+                # on a single connection
+                list(self._move_pool.map(self._move_one, new_studies))
+
         except Exception as e:
             print(f"\n✗ Error checking for new studies: {e}")
     
     def monitor(self):
         """Main monitoring loop"""
         print(f"\nMonitoring Orthanc2 for new studies...")
-        print(f"Checking every {self.poll_interval} seconds")
         print(f"Output directory: {os.path.abspath(self.output_dir)}")
         print("\nPress Ctrl+C to stop\n")
-        
+
+        # Event-driven by default - the changes long-poll returns as soon
+        # as Orthanc stores something, so there is no fixed sleep at all
+        use_changes = True
         while True:
             try:
-                self.check_for_new_studies()
-                time.sleep(self.poll_interval)
+                if use_changes:
+                    use_changes = self.check_changes()
+                    if not use_changes:
+                        print("Changes API unavailable, falling back to "
+                              f"polling the study listing every {self.poll_interval}s")
+                else:
+                    self.check_for_new_studies()
+                    time.sleep(self.poll_interval)
             except KeyboardInterrupt:
                 print("\n\nStopping monitor...")
                 break
@@ -268,6 +724,7 @@ def main():
     output_dir = os.environ.get('OUTPUT_DIR', '/dicom/output')
     poll_interval = int(os.environ.get('POLL_INTERVAL', '5'))
     reprocess_duplicates = os.environ.get('REPROCESS_DUPLICATES', 'true').lower() == 'true'
+    move_workers = int(os.environ.get('MOVE_WORKERS', '4'))
     
     print("Orthanc2 Monitor Service")
     print("=======================")
@@ -284,7 +741,8 @@ def main():
         orthanc_aet=orthanc_aet,
         output_dir=output_dir,
         poll_interval=poll_interval,
-        reprocess_duplicates=reprocess_duplicates
+        reprocess_duplicates=reprocess_duplicates,
+        move_workers=move_workers
     )
     
     try: